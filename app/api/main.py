@@ -1,38 +1,58 @@
+import re
+
 from contextlib import asynccontextmanager
 from secrets import token_urlsafe
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from fastapi import FastAPI, UploadFile, status, HTTPException, Request
-from bunnet import init_bunnet
+from fastapi import FastAPI, UploadFile, status, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse
+from bunnet import UpdateResponse
 from aiofiles import open as aopen
 
-from pymongo import MongoClient
-
 from app import settings
+from app.bootstrap import amqp_url, init_db
 
-from app.models import Product, UploadedFile
+from app.models import Product, UploadedFile, WorkerLoad, DeadLetter, ProductChange
+from app.models import UploadedFileStatus as FileProcessingStatus
 from app.schemas import (
     UploadedFileResponse,
     UploadedFileMessage,
     UploadedFileStatus,
     MultipleProducts,
+    WorkersLoadResponse,
+    DeadLettersResponse,
+    DeadLetterInfo,
+    ReplayedDeadLettersResponse,
+    ProductSnapshot,
 )
 from app.mq import MessagePublisher
+from app.scheduling import (
+    DEFAULT_PRIORITY,
+    MAX_PRIORITY,
+    estimate_seconds_left,
+    estimate_seconds_in_queue,
+)
+from app.history import product_as_of
+from app.normalization import tokenize, parse_quantity, search_tokens
+from app.api.pagination import (
+    InvalidCursorException,
+    ProductSortField,
+    find_products_page,
+    stream_products,
+)
 
 
-async def init_db():
-    client = MongoClient(settings.MONGODB_CONNECTION_URL)
-    init_bunnet(database=client["company"], document_models=[Product, UploadedFile])
+MAX_PAGE_SIZE = 1000
+FILE_SPLITTER_QUEUE = "file_uploaded"
 
+UNFINISHED_FILE_STATUSES = [
+    FileProcessingStatus.uploaded,
+    FileProcessingStatus.processing,
+]
 
-async def init_mq():
-    user = settings.RABBITMQ_USER
-    password = settings.RABBITMQ_PASSWORD
-    host = settings.RABBITMQ_HOST
-    port = settings.RABBITMQ_PORT
-    amqp_url = f"amqp://{user}:{password}@{host}:{port}/%2F"
 
-    mq = MessagePublisher(amqp_url, app_id="company-api")
+async def init_mq():
+    mq = MessagePublisher(amqp_url(), app_id="company-api")
     mq.connect()
 
     return mq
@@ -40,7 +60,7 @@ async def init_mq():
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()
+    init_db([Product, UploadedFile, WorkerLoad, DeadLetter, ProductChange])
     app.mq = await init_mq()
 
     yield
@@ -57,9 +77,14 @@ app.mq: MessagePublisher
 
 
 @app.post("/upload", response_model=UploadedFileResponse, tags=["Upload"])
-async def upload_dataset_file(file: UploadFile, request: Request):
+async def upload_dataset_file(
+    file: UploadFile,
+    request: Request,
+    priority: int = Query(DEFAULT_PRIORITY, ge=0, le=MAX_PRIORITY),
+):
     """
     Upload json file with the list of products to ingest into company database.
+    Files with higher priority are processed first (0 - lowest, 9 - highest).
     """
 
     current_time = datetime.now()
@@ -84,6 +109,7 @@ async def upload_dataset_file(file: UploadFile, request: Request):
         location=new_file_location,
         uploaded_at=current_time,
         content_type=file.content_type,
+        priority=priority,
     )
     uploaded_file.insert()
 
@@ -91,8 +117,11 @@ async def upload_dataset_file(file: UploadFile, request: Request):
         id=str(uploaded_file.id),
         location=uploaded_file.location,
         uploaded_at=current_time,
+        priority=priority,
+    )
+    app.mq.publish_message(
+        message.model_dump_json(), "company", FILE_SPLITTER_QUEUE, priority=priority
     )
-    app.mq.publish_message(message.model_dump_json(), "company", "file_uploaded")
 
     uploaded_file_id = str(uploaded_file.id)
     return {
@@ -117,16 +146,256 @@ async def file_status(file_id: str):
             detail="There is no file with this id",
         )
 
+    records_done = uploaded_file.records_processed + uploaded_file.records_failed
+
+    eta_seconds = estimate_seconds_left(
+        uploaded_file.total_records,
+        records_done,
+        uploaded_file.processing_started_at,
+        datetime.now(),
+    )
+
+    # Until the file has some progress of its own, we estimate from the files ahead of it and the recent throughput.
+    if eta_seconds is None and uploaded_file.status in UNFINISHED_FILE_STATUSES:
+        eta_seconds = estimate_seconds_in_queue(
+            records_ahead(uploaded_file),
+            max(uploaded_file.total_records - records_done, 0),
+            recent_records_per_second(),
+        )
+
     return {
         "filename": uploaded_file.filename,
         "status": uploaded_file.status,
         "uploaded_at": uploaded_file.uploaded_at,
+        "priority": uploaded_file.priority,
         "total_records": uploaded_file.total_records,
         "records_processed": uploaded_file.records_processed,
         "records_failed": uploaded_file.records_failed,
+        "dead_letters": uploaded_file.dead_letters,
+        "queue_position": file_queue_position(uploaded_file),
+        "eta_seconds": eta_seconds,
+    }
+
+
+def files_ahead_query(uploaded_file: UploadedFile) -> dict:
+    """
+    Unfinished files that are ahead of this one - with higher priority, or with the same priority
+    but uploaded earlier. Since large files are demoted over time this is only an approximation.
+    """
+
+    return {
+        "_id": {"$ne": uploaded_file.id},
+        "status": {"$in": [s.value for s in UNFINISHED_FILE_STATUSES]},
+        "$or": [
+            {"priority": {"$gt": uploaded_file.priority}},
+            {
+                "priority": uploaded_file.priority,
+                "uploaded_at": {"$lt": uploaded_file.uploaded_at},
+            },
+        ],
     }
 
 
+def file_queue_position(uploaded_file: UploadedFile) -> int | None:
+    if uploaded_file.status not in UNFINISHED_FILE_STATUSES:
+        return None
+
+    return UploadedFile.find(files_ahead_query(uploaded_file)).count()
+
+
+def records_ahead(uploaded_file: UploadedFile) -> int:
+    """
+    Number of records of the files ahead of this one that are not processed yet.
+    Files that were not pre-scanned yet don't know their number of records, so they are not counted.
+    """
+
+    records_left = {
+        "$subtract": [
+            "$total_records",
+            {"$add": ["$records_processed", "$records_failed"]},
+        ]
+    }
+    result = UploadedFile.get_motor_collection().aggregate(
+        [
+            {"$match": files_ahead_query(uploaded_file)},
+            {"$group": {"_id": None, "records": {"$sum": records_left}}},
+        ]
+    )
+
+    return next(result, {}).get("records", 0)
+
+
+def recent_worker_loads():
+    # Workers that haven't reported for a while are considered to be gone.
+    reported_after = datetime.now() - timedelta(
+        seconds=3 * settings.LOAD_REPORT_INTERVAL
+    )
+
+    return WorkerLoad.find(WorkerLoad.updated_at >= reported_after)
+
+
+def recent_records_per_second() -> float:
+    # Records are stored by DataProcessor, so its throughput is the throughput of the whole pipeline.
+    workers = recent_worker_loads().find(WorkerLoad.service == "data_processor")
+
+    return sum(worker.records_per_second for worker in workers)
+
+
+def dead_letter_info(dead_letter: DeadLetter):
+    return {
+        "id": str(dead_letter.id),
+        "queue": dead_letter.queue,
+        "file_id": dead_letter.file_id,
+        "attempts": dead_letter.attempts,
+        "error": dead_letter.error,
+        "dead_lettered_at": dead_letter.dead_lettered_at,
+        "replayed_at": dead_letter.replayed_at,
+    }
+
+
+def reset_file_for_splitting(file_id: str, replayed_at: datetime) -> int:
+    """
+    Splitting the file again publishes all of its batches again, so its progress starts over. Dead letters
+    of its batches are covered by the new split, so they are marked as replayed too.
+
+    Batches of the failed split might still be waiting in the queues. The split generation of the file is increased,
+    so DataProcessor doesn't count them. Returns the new split generation.
+    """
+
+    uploaded_file = (
+        UploadedFile.get(file_id)
+        .update(
+            {
+                "$set": {
+                    UploadedFile.status: FileProcessingStatus.uploaded,
+                    UploadedFile.processing_started_at: None,
+                    UploadedFile.total_records: 0,
+                    UploadedFile.records_processed: 0,
+                    UploadedFile.records_failed: 0,
+                    UploadedFile.dead_letters: 0,
+                },
+                "$inc": {UploadedFile.split_generation: 1},
+            },
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
+        .run()
+    )
+
+    DeadLetter.find(DeadLetter.file_id == file_id, DeadLetter.replayed_at == None).set(
+        {DeadLetter.replayed_at: replayed_at}
+    ).run()
+
+    return uploaded_file.split_generation
+
+
+def replay_dead_letter(dead_letter: DeadLetter):
+    """
+    Publish the dead-lettered message to its original queue again and mark it as replayed.
+    """
+
+    replayed_at = datetime.now()
+
+    body = dead_letter.body
+
+    # The file is reset before the message is published, so the new split doesn't count the records twice.
+    if dead_letter.queue == FILE_SPLITTER_QUEUE and dead_letter.file_id:
+        split_generation = reset_file_for_splitting(dead_letter.file_id, replayed_at)
+
+        # The whole file is split again, even if the failed split was continuing after an interrupted one.
+        message = UploadedFileMessage.model_validate_json(body)
+        body = message.model_copy(
+            update={"resume_from": 0, "split_generation": split_generation}
+        ).model_dump_json()
+
+    app.mq.publish_message(
+        body, "company", dead_letter.queue, priority=dead_letter.priority
+    )
+
+    dead_letter.replayed_at = replayed_at
+    dead_letter.save()
+
+    if dead_letter.file_id and dead_letter.queue != FILE_SPLITTER_QUEUE:
+        UploadedFile.get(dead_letter.file_id).inc({UploadedFile.dead_letters: -1}).run()
+
+
+@app.get(
+    "/upload/{file_id}/dead-letters",
+    response_model=DeadLettersResponse,
+    tags=["Upload"],
+)
+async def file_dead_letters(file_id: str):
+    """
+    List the messages (batches of records) from the uploaded file that failed processing after all retries.
+    """
+
+    dead_letters = (
+        DeadLetter.find(DeadLetter.file_id == file_id)
+        .sort("dead_lettered_at")
+        .to_list()
+    )
+
+    return {
+        "file_id": file_id,
+        "dead_letters": [dead_letter_info(d) for d in dead_letters],
+    }
+
+
+@app.post(
+    "/upload/{file_id}/dead-letters/replay",
+    response_model=ReplayedDeadLettersResponse,
+    tags=["Upload"],
+)
+async def replay_file_dead_letters(file_id: str):
+    """
+    Replay all not yet replayed dead-lettered messages of the uploaded file. If splitting of the file failed,
+    only the split is replayed and the progress of the file starts over.
+    """
+
+    dead_letters = DeadLetter.find(
+        DeadLetter.file_id == file_id, DeadLetter.replayed_at == None
+    ).to_list()
+
+    # If splitting of the file failed, the file is split again, which covers all of its batches as well.
+    splitter_dead_letters = [d for d in dead_letters if d.queue == FILE_SPLITTER_QUEUE]
+    if splitter_dead_letters:
+        dead_letters = splitter_dead_letters[-1:]
+
+    for dead_letter in dead_letters:
+        replay_dead_letter(dead_letter)
+
+    return {"replayed": len(dead_letters)}
+
+
+@app.post(
+    "/dead-letters/{dead_letter_id}/replay",
+    response_model=DeadLetterInfo,
+    tags=["Upload"],
+)
+async def replay_single_dead_letter(dead_letter_id: str):
+    """
+    Replay a single dead-lettered message. The message is sent to its original queue again.
+    Replaying a failed split resets the progress of the file and marks the dead letters of its batches as replayed.
+    """
+
+    dead_letter = DeadLetter.get(dead_letter_id).run()
+
+    if not dead_letter:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no dead letter with this id.",
+        )
+
+    if dead_letter.replayed_at:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="This dead letter was already replayed.",
+        )
+
+    replay_dead_letter(dead_letter)
+
+    return dead_letter_info(dead_letter)
+
+
 @app.get("/product/find/code/{code}", response_model=Product, tags=["Find Products"])
 async def find_product_by_code(code: str):
     """
@@ -144,41 +413,246 @@ async def find_product_by_code(code: str):
     return product
 
 
+def products_response(
+    query: dict,
+    sort_by: ProductSortField,
+    limit: int,
+    cursor: str | None,
+    stream: bool,
+    extra_fields: dict | None = None,
+):
+    """
+    Shared logic of the find/scan APIs. Returns a page of products or, if stream is set,
+    an NDJSON stream of all products after the cursor.
+    """
+
+    try:
+        if stream:
+            return StreamingResponse(
+                stream_products(query, sort_by, cursor),
+                media_type="application/x-ndjson",
+            )
+
+        products, next_cursor = find_products_page(query, sort_by, limit, cursor)
+    except InvalidCursorException as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+
+    return {**(extra_fields or {}), "products": products, "next_cursor": next_cursor}
+
+
+@app.get(
+    "/product/history/{code}",
+    response_model=ProductSnapshot,
+    tags=["Find Products"],
+)
+async def product_history(
+    code: str, at: datetime | None = None, file_id: str | None = None
+):
+    """
+    Reconstruct the product as it was at the time `at` or right after it was loaded from the uploaded file `file_id`.
+    Without parameters returns the latest version from the history.
+    """
+
+    version = None
+    if file_id:
+        change = ProductChange.find_one(
+            ProductChange.code == code, ProductChange.file_id == file_id
+        ).run()
+
+        if change:
+            version = change.version
+        else:
+            # The file didn't change the product, so we take the product as it was when the file was uploaded.
+            uploaded_file = UploadedFile.get(file_id).run()
+            if not uploaded_file:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="There is no file with this id",
+                )
+            at = uploaded_file.uploaded_at
+
+    snapshot = product_as_of(code, at=at, version=version)
+
+    if not snapshot:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no history of the product with this code for that time.",
+        )
+
+    product, last_change = snapshot
+
+    return {
+        "code": code,
+        "version": last_change.version,
+        "file_id": last_change.file_id,
+        "changed_at": last_change.changed_at,
+        "product": product,
+    }
+
+
 @app.get(
     "/product/find/name/partial/{product_name}",
     response_model=MultipleProducts,
     tags=["Find Products"],
 )
-async def find_products_partial(product_name: str):
+async def find_products_partial(
+    product_name: str,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    stream: bool = False,
+):
     """
-    Find top 20 products that contain product_name in the product_name field.
+    Find products that contain product_name in the product_name field, ordered by product_name.
+    Returns up to `limit` products; pass the returned `next_cursor` as `cursor` to get the next page.
+    If `stream` is set, all matches are returned as NDJSON.
     """
 
-    regex_pattern = f".*{product_name}.*"
+    # The search term is matched literally, so characters like "(" or "[" don't break the query.
+    query = {"product_name": {"$regex": re.escape(product_name), "$options": "i"}}
 
-    products = (
-        Product.find({"product_name": {"$regex": regex_pattern, "$options": "i"}})
-        .limit(20)
-        .to_list()
+    return products_response(
+        query,
+        ProductSortField.product_name,
+        limit,
+        cursor,
+        stream,
+        extra_fields={"search_term": product_name},
     )
 
-    response = {"search_term": product_name, "products": products}
 
-    return response
+@app.get(
+    "/product/find/name/exact/{product_name}",
+    response_model=MultipleProducts,
+    tags=["Find Products"],
+)
+async def find_products_exact(
+    product_name: str,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    stream: bool = False,
+):
+    """
+    Find products that exactly match the product name. All of them have the same name, so they are ordered by _id,
+    which is served by the (product_name, _id) index.
+    Returns up to `limit` products; pass the returned `next_cursor` as `cursor` to get the next page.
+    If `stream` is set, all matches are returned as NDJSON.
+    """
+
+    query = {"product_name": product_name}
+
+    return products_response(
+        query,
+        ProductSortField.product_name,
+        limit,
+        cursor,
+        stream,
+        extra_fields={"search_term": product_name},
+    )
 
 
 @app.get(
-    "/product/find/name/exact/{product_name}",
+    "/product/find/match",
     response_model=MultipleProducts,
     tags=["Find Products"],
 )
-async def find_products_exact(product_name: str):
+async def find_products_by_match_keys(
+    name: str,
+    brand: str | None = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    stream: bool = False,
+):
     """
-    Find products that exactly match the product name. Show at most 20 results.
+    Find candidate products for a receipt line using the precomputed match keys, ordered by code.
+    Every word from `name` must be a prefix of a word in the normalized product name, so abbreviations
+    like "CHOC MLK" work. If `name` contains a quantity (e.g. "4X125G") it must match the product quantity.
+    If `brand` is set, at least one of its words must match the product brands.
+    `name` must contain at least one word besides the quantity, the quantity alone would match a large part
+    of the catalog and isn't indexed.
     """
 
-    products = Product.find(Product.product_name == product_name)
+    name_tokens = search_tokens(name)
+    if not name_tokens:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Search term does not contain any words to match.",
+        )
+
+    query = {
+        "match_keys.name_tokens": {
+            "$all": [re.compile(f"^{re.escape(token)}") for token in name_tokens]
+        }
+    }
+
+    if quantity := parse_quantity(name):
+        query["match_keys.quantity_value"] = quantity[0]
+        query["match_keys.quantity_unit"] = quantity[1]
+
+    if brand_tokens := tokenize(brand):
+        query["match_keys.brand_tokens"] = {"$in": brand_tokens}
+
+    return products_response(
+        query,
+        ProductSortField.code,
+        limit,
+        cursor,
+        stream,
+        extra_fields={"search_term": name},
+    )
+
 
-    response = {"search_term": product_name, "products": products}
+@app.get("/product/scan", response_model=MultipleProducts, tags=["Find Products"])
+async def scan_products(
+    sort_by: ProductSortField = ProductSortField.code,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    stream: bool = False,
+):
+    """
+    Walk the whole products catalog ordered by one of the indexed fields.
+    Pass the returned `next_cursor` as `cursor` to get the next page.
+    If `stream` is set, all products after the cursor are returned as NDJSON.
+    """
+
+    return products_response({}, sort_by, limit, cursor, stream)
+
+
+@app.get("/workers/load", response_model=WorkersLoadResponse, tags=["Workers"])
+async def workers_load():
+    """
+    Load of the running DataProcessor and FileSplitter workers: queue depth, consumer utilization (share of time
+    spent processing messages) and records processed per second. Can be used as a signal for autoscaling.
+    """
+
+    workers = recent_worker_loads().sort("service", "worker_id").to_list()
+
+    services = {}
+    for worker in workers:
+        services.setdefault(worker.service, []).append(worker)
+
+    response = []
+    for service, service_workers in services.items():
+        # Queue depth is the same for all workers of a service, so we take the latest reported one.
+        latest = max(service_workers, key=lambda w: w.updated_at)
+
+        response.append(
+            {
+                "service": service,
+                "queue": latest.queue,
+                "queue_depth": latest.queue_depth,
+                "workers": len(service_workers),
+                "utilization": round(
+                    sum(w.utilization for w in service_workers) / len(service_workers),
+                    3,
+                ),
+                "records_per_second": round(
+                    sum(w.records_per_second for w in service_workers), 1
+                ),
+                "worker_load": [w.model_dump() for w in service_workers],
+            }
+        )
 
-    return response
+    return {"services": response}
@@ -0,0 +1,152 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from enum import Enum
+from typing import Iterator
+
+from bson import json_util
+from bson.errors import BSONError
+from pymongo import ASCENDING
+
+from app.models import Product
+
+
+# Number of documents fetched from MongoDB per round trip when streaming results.
+# It bounds the memory used by a single streaming request no matter how large the result set is.
+STREAM_BATCH_SIZE = 500
+
+
+class InvalidCursorException(Exception):
+    pass
+
+
+class ProductSortField(str, Enum):
+    """
+    Indexed fields by which products can be paginated.
+    """
+
+    code = "code"
+    product_name = "product_name"
+    last_modified_at_company = "last_modified_at_company"
+
+
+# Fields with a unique index don't need _id as a tie-breaker, so the single-field index serves the sort.
+UNIQUE_SORT_FIELDS = {ProductSortField.code}
+
+
+def encode_cursor(sort_by: ProductSortField, product: Product) -> str:
+    """
+    Create an opaque continuation token pointing right after the given product.
+
+    We use bson json_util so the values keep their types (ObjectId, datetime) when decoded.
+    """
+
+    payload = {
+        "s": sort_by.value,
+        "v": getattr(product, sort_by.value, None),
+        "id": product.id,
+    }
+
+    return urlsafe_b64encode(json_util.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_by: ProductSortField) -> dict:
+    try:
+        payload = json_util.loads(urlsafe_b64decode(cursor.encode()))
+    except (BinasciiError, BSONError, ValueError, TypeError) as e:
+        raise InvalidCursorException("Cursor is not valid.") from e
+
+    if not isinstance(payload, dict) or "v" not in payload or "id" not in payload:
+        raise InvalidCursorException("Cursor is not valid.")
+
+    if payload.get("s") != sort_by.value:
+        raise InvalidCursorException(
+            f"Cursor was not created for sorting by {sort_by.value}."
+        )
+
+    return payload
+
+
+def keyset_query(query: dict, sort_by: ProductSortField, cursor: str | None) -> dict:
+    """
+    Extend the query so it only matches products that come after the cursor in (sort_by, _id) order
+    (sort_by alone for unique fields).
+    Unlike skip/offset this stays an index range scan no matter how deep into the results we are.
+    """
+
+    if not cursor:
+        return query
+
+    payload = decode_cursor(cursor, sort_by)
+    field = sort_by.value
+    last_value = payload["v"]
+    last_id = payload["id"]
+
+    # MongoDB sorts missing and null values before everything else, so they need special handling.
+    if sort_by in UNIQUE_SORT_FIELDS:
+        after_cursor = {field: {"$gt": last_value}}
+    elif last_value is None:
+        after_cursor = {
+            "$or": [
+                {field: None, "_id": {"$gt": last_id}},
+                {field: {"$ne": None}},
+            ]
+        }
+    else:
+        after_cursor = {
+            "$or": [
+                {field: {"$gt": last_value}},
+                {field: last_value, "_id": {"$gt": last_id}},
+            ]
+        }
+
+    if not query:
+        return after_cursor
+
+    return {"$and": [query, after_cursor]}
+
+
+def sort_expression(sort_by: ProductSortField) -> list[tuple[str, int]]:
+    if sort_by in UNIQUE_SORT_FIELDS:
+        return [(sort_by.value, ASCENDING)]
+
+    # _id is added as a tie-breaker so the order is total even for non-unique fields.
+    return [(sort_by.value, ASCENDING), ("_id", ASCENDING)]
+
+
+def find_products_page(
+    query: dict, sort_by: ProductSortField, limit: int, cursor: str | None = None
+) -> tuple[list[Product], str | None]:
+    """
+    Return one page of products and the cursor for the next page (None if this is the last page).
+    """
+
+    products = (
+        Product.find(keyset_query(query, sort_by, cursor))
+        .sort(sort_expression(sort_by))
+        .limit(limit + 1)  # Fetch one more so we know if there is a next page.
+        .to_list()
+    )
+
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = encode_cursor(sort_by, products[-1])
+
+    return products, next_cursor
+
+
+def stream_products(
+    query: dict, sort_by: ProductSortField, cursor: str | None = None
+) -> Iterator[str]:
+    """
+    Return an iterator over all matching products as NDJSON lines.
+
+    The Mongo cursor is iterated in batches of STREAM_BATCH_SIZE, so only one batch is held in memory at a time.
+    The query is built eagerly, so an invalid cursor is raised here and not after the response has started.
+    """
+
+    products = Product.find(
+        keyset_query(query, sort_by, cursor), batch_size=STREAM_BATCH_SIZE
+    ).sort(sort_expression(sort_by))
+
+    return (product.model_dump_json(by_alias=True) + "\n" for product in products)
@@ -0,0 +1,71 @@
+from functools import cache
+
+from bunnet import init_bunnet
+from bunnet.odm.utils.init import Initializer
+from pymongo import MongoClient
+from pymongo.database import Database
+
+from app import settings
+
+
+# Shared startup code of the API and the worker services. Indexes are not created on startup, that is done once by
+# the migration step (python -m app.migrate) before the services are started.
+
+DATABASE_NAME = "company"
+
+
+class InitializerWithoutIndexes(Initializer):
+    # Initializer is internal to bunnet, this depends on the pinned version (see requirements-worker.txt).
+    def init_indexes(self, cls, allow_index_dropping: bool = False):
+        pass
+
+
+class ServerVersionCachingDatabase(Database):
+    """
+    Bunnet asks for the server version (buildInfo command) once for every document model it initializes.
+    The version doesn't change while the process runs, so we ask only once.
+    """
+
+    def command(self, command, *args, **kwargs):
+        if command == {"buildInfo": 1} and not args and not kwargs:
+            return server_build_info()
+
+        return super().command(command, *args, **kwargs)
+
+
+def amqp_url():
+    user = settings.RABBITMQ_USER
+    password = settings.RABBITMQ_PASSWORD
+    host = settings.RABBITMQ_HOST
+    port = settings.RABBITMQ_PORT
+
+    return f"amqp://{user}:{password}@{host}:{port}/%2F"
+
+
+@cache
+def mongo_client():
+    # One client (and connection pool) per process. MongoClient is not fork-safe, so it must be created in the
+    # worker process itself and not in the supervisor.
+    return MongoClient(settings.MONGODB_CONNECTION_URL)
+
+
+@cache
+def server_build_info():
+    return mongo_client()[DATABASE_NAME].command({"buildInfo": 1})
+
+
+def init_db(document_models, create_indexes=False):
+    """
+    Initialize the Bunnet ODM for the given document models.
+
+    By default, it skips the creation of indexes, which needs a round trip to MongoDB for every model
+    (and can take a long time on big collections), so the services start quickly.
+    """
+
+    database = ServerVersionCachingDatabase(mongo_client(), DATABASE_NAME)
+
+    if create_indexes:
+        init_bunnet(database=database, document_models=document_models)
+        return
+
+    InitializerWithoutIndexes(database=database, document_models=document_models).run()
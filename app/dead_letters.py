@@ -0,0 +1,30 @@
+from datetime import datetime
+
+from bson import ObjectId
+from app.models import DeadLetter, UploadedFile
+
+
+def store_dead_letter(queue, file_id, body, properties, attempts, error):
+    """
+    Store the message that failed all retries and link it to its UploadedFile, so it can be replayed through the API.
+    """
+
+    # The file_id comes from the message, which might be malformed.
+    if not ObjectId.is_valid(file_id):
+        file_id = None
+
+    dead_letter = DeadLetter(
+        queue=queue,
+        file_id=file_id,
+        body=body.decode() if isinstance(body, bytes) else body,
+        priority=properties.priority,
+        attempts=attempts,
+        error=repr(error),
+        dead_lettered_at=datetime.now(),
+    )
+    dead_letter.insert()
+
+    if file_id:
+        UploadedFile.get(file_id).inc({UploadedFile.dead_letters: 1}).run()
+
+    return dead_letter
@@ -0,0 +1,149 @@
+from datetime import datetime
+
+from app.models import Product, ProductChange
+
+
+# Every CHECKPOINT_EVERY-th change of a product stores its full content instead of a diff. Reconstructing a product
+# then never needs more than one checkpoint and CHECKPOINT_EVERY - 1 diffs.
+CHECKPOINT_EVERY = 10
+
+# Version of the checkpoint with the content of a product that was stored before the history was kept,
+# written right before its first recorded change.
+BASELINE_VERSION = 0
+
+# Fields that change on every load (or are derived from the other fields), so they are not part of the history.
+IGNORED_FIELDS = {
+    "_id",
+    "id",
+    "revision_id",
+    "file_id",
+    "last_modified_at_company",
+    "match_keys",
+    "history_version",
+}
+
+
+def product_content(product: dict) -> dict:
+    return {k: v for k, v in product.items() if k not in IGNORED_FIELDS}
+
+
+def diff_product(old: dict, new: dict) -> dict:
+    """
+    Fields of the new product content that are different from the old one.
+    Products are upserted with $set, so fields that are missing from the new record keep their old value
+    and there is nothing to record for them.
+    """
+
+    return {k: v for k, v in new.items() if k not in old or old[k] != v}
+
+
+def build_product_change(
+    current: dict | None, new: dict, version: int, file_id: str, changed_at: datetime
+) -> dict | None:
+    """
+    Compare the stored product (None if it doesn't exist yet) with the new one and return the history entry
+    with the given (reserved) version for the change, or None if the content didn't change.
+    """
+
+    old_content = product_content(current) if current else {}
+    changes = diff_product(old_content, product_content(new))
+
+    if not changes:
+        return None
+
+    # The first recorded change is always a checkpoint, so products stored before the history was kept
+    # can be reconstructed too.
+    checkpoint = version == 1 or version % CHECKPOINT_EVERY == 0
+    if checkpoint:
+        changes = {**old_content, **changes}
+
+    return {
+        "code": new["code"],
+        "version": version,
+        "file_id": file_id,
+        "changed_at": changed_at,
+        "checkpoint": checkpoint,
+        "changes": changes,
+    }
+
+
+def build_baseline_checkpoint(current: dict) -> dict:
+    return {
+        "code": current["code"],
+        "version": BASELINE_VERSION,
+        "file_id": current["file_id"],
+        "changed_at": current.get("last_modified_at_company") or datetime.min,
+        "checkpoint": True,
+        "changes": product_content(current),
+    }
+
+
+def product_as_of(
+    code: str, at: datetime | None = None, version: int | None = None
+) -> tuple[dict, ProductChange] | None:
+    """
+    Reconstruct the product content as it was at the given time (or version) from the latest checkpoint before it
+    and the diffs after that checkpoint. Returns the content and the last applied change, or None if there is no
+    history of the product for that time.
+
+    A product that didn't change after the given time is the same as the stored one, even if it has no history
+    (it was stored before the history was kept and never changed since).
+    """
+
+    if version is not None:
+        as_of_filter = {"version": {"$lte": version}}
+    else:
+        as_of_filter = {"changed_at": {"$lte": at or datetime.now()}}
+
+    checkpoint = (
+        ProductChange.find({"code": code, "checkpoint": True, **as_of_filter})
+        .sort("-version")
+        .first_or_none()
+    )
+
+    # A reserved version can be missing (e.g. the worker died before it stored the entry), so if the first checkpoint
+    # is missing we start with the first stored change.
+    after_version = checkpoint.version if checkpoint else BASELINE_VERSION - 1
+    changes = (
+        ProductChange.find(
+            {"code": code, "version": {"$gt": after_version}, **as_of_filter}
+        )
+        .sort("+version")
+        .to_list()
+    )
+
+    if not checkpoint and not changes:
+        if version is None:
+            return current_product_if_unchanged_since(code, at or datetime.now())
+        return None
+
+    content = dict(checkpoint.changes) if checkpoint else {}
+    last_change = checkpoint
+    for change in changes:
+        content.update(change.changes)
+        last_change = change
+
+    return content, last_change
+
+
+def current_product_if_unchanged_since(
+    code: str, at: datetime
+) -> tuple[dict, ProductChange] | None:
+    if ProductChange.find({"code": code, "changed_at": {"$gt": at}}).first_or_none():
+        return None
+
+    product = Product.get_motor_collection().find_one({"code": code})
+    if not product:
+        return None
+
+    # Not a stored entry, it only describes the stored product the same way as the history entries do.
+    current = ProductChange(
+        code=code,
+        version=product.get("history_version", BASELINE_VERSION),
+        file_id=product["file_id"],
+        changed_at=product.get("last_modified_at_company") or datetime.min,
+        checkpoint=True,
+        changes=product_content(product),
+    )
+
+    return current.changes, current
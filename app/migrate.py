@@ -0,0 +1,17 @@
+import logging
+
+from app.bootstrap import init_db
+from app.models import DOCUMENT_MODELS
+
+
+logger = logging.getLogger("migrate")
+
+
+def main():
+    # Creating indexes is idempotent, so this can be run before every deployment.
+    init_db(DOCUMENT_MODELS, create_indexes=True)
+    logger.warning("Indexes created.")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,31 @@ from datetime import datetime
 from enum import Enum
 
 from bunnet import Document, Indexed, before_event, Insert, Replace
+from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+
+from app.scheduling import DEFAULT_PRIORITY
+
+
+class ProductMatchKeys(BaseModel):
+    """
+    Normalized product data used for matching receipt lines to products. Computed on ingest.
+    """
+
+    name: str | None = None
+    name_tokens: list[str] = []
+    brand_tokens: list[str] = []
+
+    quantity_value: float | None = None
+    quantity_unit: str | None = None
 
 
 class Product(Document):
     code: Indexed(str, unique=True)
     product_name: str | None = None
 
+    match_keys: ProductMatchKeys | None = None
+
     last_modified_at_company: datetime | None = None
 
     file_id: str
@@ -17,7 +36,13 @@ class Product(Document):
 
     class Settings:
         name = "products"
-        indexes = ["product_name"]
+        # Compound indexes with _id support the keyset (cursor) pagination in the find APIs.
+        indexes = [
+            IndexModel([("product_name", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("last_modified_at_company", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("match_keys.name_tokens", ASCENDING)]),
+            IndexModel([("match_keys.brand_tokens", ASCENDING)]),
+        ]
 
     @before_event(Insert, Replace)
     def update_last_modified(self):
@@ -38,10 +63,82 @@ class UploadedFile(Document):
     uploaded_at: datetime
     content_type: str
     status: UploadedFileStatus = UploadedFileStatus.uploaded
+    priority: int = DEFAULT_PRIORITY
+    processing_started_at: datetime | None = None
 
     total_records: int = 0
     records_processed: int = 0
     records_failed: int = 0
+    # Number of messages (batches) from this file that failed all retries and were not replayed yet.
+    dead_letters: int = 0
+    # Increased when a failed split is replayed, so the batches of the failed split aren't counted to the progress.
+    split_generation: int = 0
 
     class Settings:
         name = "uploaded_files"
+        indexes = ["status"]
+
+
+class WorkerLoad(Document):
+    """
+    Load of a single DataProcessor/FileSplitter worker, reported periodically while the worker is consuming.
+    """
+
+    service: str
+    worker_id: Indexed(str, unique=True)
+    queue: str
+
+    queue_depth: int = 0
+    consumers: int = 0
+    utilization: float = 0
+    records_per_second: float = 0
+
+    updated_at: datetime
+
+    class Settings:
+        name = "worker_load"
+
+
+class DeadLetter(Document):
+    """
+    Message that failed processing after all retries. We keep the message body, so it can be replayed.
+    """
+
+    queue: str
+    file_id: Indexed(str) | None = None
+    body: str
+    priority: int | None = None
+
+    attempts: int
+    error: str
+    dead_lettered_at: datetime
+    replayed_at: datetime | None = None
+
+    class Settings:
+        name = "dead_letters"
+
+
+class ProductChange(Document):
+    """
+    Entry in the append-only product history. Contains only the fields that were changed by the file
+    or, if checkpoint is set, the full product content. See app/history.py.
+    """
+
+    code: str
+    version: int
+    file_id: str
+    changed_at: datetime
+    checkpoint: bool = False
+
+    changes: dict
+
+    class Settings:
+        name = "product_history"
+        indexes = [
+            IndexModel([("code", ASCENDING), ("version", ASCENDING)], unique=True),
+            IndexModel([("code", ASCENDING), ("changed_at", ASCENDING)]),
+        ]
+
+
+# All document models, used by the migration which creates the indexes.
+DOCUMENT_MODELS = [Product, UploadedFile, WorkerLoad, DeadLetter, ProductChange]
@@ -1,4 +1,7 @@
 import logging
+import signal
+import time
+
 import pika
 
 from pika.adapters.asyncio_connection import AsyncioConnection
@@ -15,16 +18,45 @@ logger = logging.getLogger(__name__)
 logging.getLogger("pika").setLevel(logging.WARNING)
 
 
+# Header in which we keep the number of the delivery attempt of a message (see MessageConsumer.handle_failed_message).
+ATTEMPT_HEADER = "x-attempt"
+# Header with the publish sequence number of a republished message, so a returned message can be matched
+# to its publisher confirm (see MessageConsumer.republish_message).
+PUBLISH_SEQUENCE_HEADER = "x-publish-sequence"
+
+
 class RabbitMQException(Exception):
     pass
 
 
+class MessageInterrupted(Exception):
+    """
+    Raised by a consumer method that stopped processing a long-running message because the consumer is draining.
+    The message is put back to the queue with the given body (which records the progress), so the next consumer
+    continues where this one stopped.
+    """
+
+    def __init__(self, body, records=0):
+        super().__init__("Message processing was interrupted by drain.")
+        self.body = body
+        self.records = records
+
+
+def retry_queue_name(queue, retry):
+    return f"{queue}.retry.{retry}"
+
+
+def dead_letter_queue_name(queue):
+    return f"{queue}.dead_letter"
+
+
 class MessagePublisher:
     """Class to make it easier to publish messages to RabbitMQ"""
 
     def __init__(self, amqp_url: str, app_id: str):
         self._connection = None
         self._channel = None
+        self._draining = False
 
         self._url = amqp_url
 
@@ -47,9 +79,13 @@ class MessagePublisher:
     def on_connection_open_error(self, _unused_connection, err):
         logger.error("Connection open failed: %s", err)
 
-    def on_connection_closed(self, _unused_connection, reason):
-        logger.warning("Connection closed: %s", reason)
+    def on_connection_closed(self, connection, reason):
         self._channel = None
+        if self._draining:
+            connection.ioloop.stop()
+            return
+
+        logger.warning("Connection closed: %s", reason)
 
     def on_channel_open(self, channel):
         self._channel = channel
@@ -61,15 +97,23 @@ class MessagePublisher:
     def on_channel_closed(self, channel, reason):
         self._channel = None
 
-    def publish_message(self, message, exchange, routing_key):
+    def publish_message(self, message, exchange, routing_key, priority=None):
         if self._channel is None or not self._channel.is_open:
             raise RabbitMQException("Channel closed.")
 
+        properties = self._properties
+        if priority is not None:
+            properties = pika.BasicProperties(
+                app_id=self._properties.app_id,
+                content_type=self._properties.content_type,
+                priority=priority,
+            )
+
         self._channel.basic_publish(
             exchange,
             routing_key,
             message,
-            self._properties,
+            properties,
         )
 
     def close(self):
@@ -77,14 +121,43 @@ class MessagePublisher:
             self._connection.close()
             self._connection = None
 
+    def drain(self):
+        """
+        Close the connection and run the ioloop until it is closed.
+        Pika sends the close frame after all buffered messages, so this makes sure that all published messages
+        were flushed to RabbitMQ. Must not be called while the ioloop is running.
+        """
+        if not self._connection or not self._connection.is_open:
+            return
+
+        ioloop = self._connection.ioloop
+        self._draining = True
+        self.close()
+        ioloop.run_forever()
+
 
 class MessageConsumer:
     """Class to make it easier to consume messages from RabbitMQ"""
 
-    def __init__(self, amqp_url, queue, exchange, consumer_method):
+    # Shared memory flag (multiprocessing.Value) set by the worker supervisor in the workers it forks.
+    # It is set while a message is being processed, so the supervisor knows which workers are busy.
+    busy_flag = None
+
+    def __init__(
+        self,
+        amqp_url,
+        queue,
+        exchange,
+        consumer_method,
+        on_load_report=None,
+        load_report_interval=10,
+        retries=0,
+        on_dead_letter=None,
+    ):
         self._connection = None
         self._channel = None
         self._closing = False
+        self._drain_requested = False
         self._consumer_tag = None
         self._url = amqp_url
         self._queue = queue
@@ -95,6 +168,24 @@ class MessageConsumer:
 
         self._prefetch_count = 1
 
+        # Failed messages are retried through the retry queues (declared in rabbitmq_definitions.json) and
+        # dead-lettered after that - see handle_failed_message.
+        self._retries = retries
+        self._on_dead_letter = on_dead_letter
+
+        # Republished messages wait for the publisher confirm before the original message is acknowledged.
+        self._publish_sequence = 0
+        self._awaiting_confirmation = {}
+        self._returned = set()
+
+        # Load reporting - see report_load.
+        self._on_load_report = on_load_report
+        self._load_report_interval = load_report_interval
+        self._load_report_handle = None
+        self._window_started_at = time.monotonic()
+        self._window_busy_seconds = 0.0
+        self._window_records = 0
+
     def connect(self):
         return AsyncioConnection(
             parameters=pika.URLParameters(self._url),
@@ -116,6 +207,10 @@ class MessageConsumer:
 
     def on_connection_closed(self, _unused_connection, reason):
         self._channel = None
+        if self._load_report_handle:
+            self._load_report_handle.cancel()
+            self._load_report_handle = None
+
         if self._closing:
             self._connection.ioloop.stop()
 
@@ -125,6 +220,16 @@ class MessageConsumer:
     def on_channel_open(self, channel):
         self._channel = channel
         self.add_on_channel_close_callback()
+
+        self._publish_sequence = 0
+        self._awaiting_confirmation = {}
+        self._returned = set()
+        self._channel.add_on_return_callback(self.on_message_returned)
+        self._channel.confirm_delivery(
+            self.on_delivery_confirmation, callback=self.on_confirm_select_ok
+        )
+
+    def on_confirm_select_ok(self, _unused_frame):
         self.setup_queue(self._queue)
 
     def add_on_channel_close_callback(self):
@@ -151,6 +256,7 @@ class MessageConsumer:
         self.add_on_cancel_callback()
         self._consumer_tag = self._channel.basic_consume(self._queue, self.on_message)
         self._consuming = True
+        self.schedule_load_report()
 
     def add_on_cancel_callback(self):
         self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
@@ -163,22 +269,147 @@ class MessageConsumer:
         """
         Invoked by pika when a message is delivered from RabbitMQ.
         It calls the _consume_message method that was passed on creation of the MessageConsumer object.
+        The method can return the number of records it has processed, which is used for load reporting.
 
-        If there is an unhandled error while processing it redelivers the message.
+        If there is an unhandled error while processing it retries the message later or dead-letters it.
+        If the method was interrupted by drain (MessageInterrupted), the rest of the work is put back to the queue.
         """
+        started_at = time.monotonic()
+        self.set_busy(True)
         try:
-            self._consume_message(body, basic_deliver, properties)
+            records = self._consume_message(body, basic_deliver, properties)
+        except MessageInterrupted as e:
+            self._window_records += e.records
+            self.republish_message(
+                self._queue, e.body, properties, {}, basic_deliver.delivery_tag
+            )
+            return
         except Exception as e:
-            self.redeliver_message(basic_deliver.delivery_tag)
+            self.handle_failed_message(basic_deliver, properties, body, e)
             return
+        finally:
+            self._window_busy_seconds += time.monotonic() - started_at
+            self.set_busy(False)
 
+        self._window_records += records or 0
         self.acknowledge_message(basic_deliver.delivery_tag)
 
+    def set_busy(self, busy):
+        if MessageConsumer.busy_flag is not None:
+            MessageConsumer.busy_flag.value = busy
+
     def acknowledge_message(self, delivery_tag):
         self._channel.basic_ack(delivery_tag)
 
-    def redeliver_message(self, delivery_tag):
-        self._channel.basic_nack(delivery_tag)
+    def reject_message(self, delivery_tag):
+        # Rejected messages are routed to the dead letter queue by RabbitMQ (x-dead-letter-* queue arguments).
+        self._channel.basic_nack(delivery_tag, requeue=False)
+
+    def handle_failed_message(self, basic_deliver, properties, body, error):
+        """
+        Instead of requeueing the failed message right away (which would make it spin in a hot redelivery loop),
+        we publish it to the retry queue for this attempt. Retry queues have a growing TTL and dead-letter expired
+        messages back to the original queue, which gives us exponential backoff.
+
+        After all retries are used up, the message is passed to the on_dead_letter method (which stores it, so it can
+        be replayed) or, if there isn't one or it fails, rejected to the dead letter queue.
+        """
+        attempt = (properties.headers or {}).get(ATTEMPT_HEADER, 1)
+
+        if attempt <= self._retries:
+            logger.warning(
+                "Message from queue %s failed on attempt %s, retrying: %s",
+                self._queue,
+                attempt,
+                error,
+            )
+            self.republish_message(
+                retry_queue_name(self._queue, attempt),
+                body,
+                properties,
+                {ATTEMPT_HEADER: attempt + 1},
+                basic_deliver.delivery_tag,
+            )
+            return
+
+        logger.error(
+            "Message from queue %s failed on attempt %s, dead-lettering it: %s",
+            self._queue,
+            attempt,
+            error,
+        )
+
+        if self._on_dead_letter:
+            try:
+                self._on_dead_letter(body, properties, attempt, error)
+            except Exception as e:
+                logger.error("Could not store dead-lettered message: %s", e)
+            else:
+                self.acknowledge_message(basic_deliver.delivery_tag)
+                return
+
+        self.reject_message(basic_deliver.delivery_tag)
+
+    def republish_message(self, queue, body, properties, headers, delivery_tag):
+        """
+        Publish the message to the queue (through the default exchange) on the consumer channel and acknowledge
+        the original delivery only after RabbitMQ confirmed the publish (see on_delivery_confirmation),
+        so the message can't get lost in between.
+        """
+        self._publish_sequence += 1
+        self._awaiting_confirmation[self._publish_sequence] = delivery_tag
+
+        self._channel.basic_publish(
+            "",
+            queue,
+            body,
+            pika.BasicProperties(
+                app_id=properties.app_id,
+                content_type=properties.content_type,
+                priority=properties.priority,
+                headers={
+                    **(properties.headers or {}),
+                    **headers,
+                    PUBLISH_SEQUENCE_HEADER: self._publish_sequence,
+                },
+                delivery_mode=properties.delivery_mode,
+            ),
+            mandatory=True,
+        )
+
+    def on_message_returned(self, _unused_channel, method, properties, _unused_body):
+        # Returned (unroutable) messages are confirmed too, the return always comes before the confirm.
+        sequence = (properties.headers or {}).get(PUBLISH_SEQUENCE_HEADER)
+        logger.error(
+            "Republished message %s was returned: %s", sequence, method.reply_text
+        )
+        self._returned.add(sequence)
+
+    def on_delivery_confirmation(self, method_frame):
+        confirmed = method_frame.method.NAME == "Basic.Ack"
+        last_sequence = method_frame.method.delivery_tag
+
+        if method_frame.method.multiple:
+            sequences = [s for s in self._awaiting_confirmation if s <= last_sequence]
+        else:
+            sequences = [last_sequence]
+
+        for sequence in sorted(sequences):
+            delivery_tag = self._awaiting_confirmation.pop(sequence, None)
+            if delivery_tag is None:
+                continue
+
+            if confirmed and sequence not in self._returned:
+                self.acknowledge_message(delivery_tag)
+            else:
+                logger.error("Republished message %s was not delivered.", sequence)
+                self.reject_message(delivery_tag)
+
+            self._returned.discard(sequence)
+
+        # Draining waits for the outstanding confirms before closing the channel.
+        if self._closing and not self._consuming and not self._awaiting_confirmation:
+            self.close_channel()
 
     def stop_consuming(self):
         if self._channel:
@@ -186,20 +417,89 @@ class MessageConsumer:
 
     def on_cancelok(self, _unused_frame):
         self._consuming = False
-        self.close_channel()
+        if not self._awaiting_confirmation:
+            self.close_channel()
 
     def close_channel(self):
         self._channel.close()
 
+    def schedule_load_report(self):
+        if self._on_load_report and self._load_report_handle is None:
+            self._load_report_handle = self._connection.ioloop.call_later(
+                self._load_report_interval, self.report_load
+            )
+
+    def report_load(self):
+        """
+        Invoked periodically while consuming. Checks the queue depth (passive declare doesn't change the queue)
+        and calls the on_load_report method with the load of this consumer since the last report.
+        """
+        self._load_report_handle = None
+        if self._channel is None or not self._channel.is_open or self._closing:
+            return
+
+        self._channel.queue_declare(
+            self._queue, passive=True, callback=self.on_queue_declare_ok
+        )
+
+    def on_queue_declare_ok(self, method_frame):
+        now = time.monotonic()
+        elapsed = max(now - self._window_started_at, 1e-6)
+
+        load = {
+            "queue": self._queue,
+            "queue_depth": method_frame.method.message_count,
+            "consumers": method_frame.method.consumer_count,
+            "utilization": round(min(self._window_busy_seconds / elapsed, 1.0), 3),
+            "records_per_second": round(self._window_records / elapsed, 1),
+        }
+
+        self._window_started_at = now
+        self._window_busy_seconds = 0.0
+        self._window_records = 0
+
+        try:
+            self._on_load_report(load)
+        except Exception as e:
+            logger.warning("Could not report consumer load: %s", e)
+
+        self.schedule_load_report()
+
+    @property
+    def drain_requested(self):
+        # Long-running consumer methods check this to stop early (see MessageInterrupted).
+        return self._drain_requested or self._closing
+
+    def on_stop_signal(self, _signum, _frame):
+        # Python runs signal handlers between bytecodes, so the flag is set even while a message is being processed
+        # (a handler registered with the ioloop would only run after it). drain itself runs in the ioloop.
+        self._drain_requested = True
+        self._connection.ioloop.call_soon_threadsafe(self.drain)
+
+    def drain(self):
+        """
+        Stop consuming gracefully. Messages are processed synchronously in the ioloop, so by the time this is
+        called the in-flight message was already processed and acknowledged (or republished, then the channel
+        is closed once the publish is confirmed). It is safe to call from within the running ioloop;
+        run returns once the connection is closed.
+        """
+        if self._closing:
+            return
+
+        logger.warning("Draining consumer of queue %s.", self._queue)
+        self._closing = True
+        if self._consuming and self._channel:
+            self.stop_consuming()
+        elif self._connection and self._connection.is_open:
+            self._connection.close()
+        else:
+            self._connection.ioloop.stop()
+
     def run(self):
         self._connection = self.connect()
-        self._connection.ioloop.run_forever()
 
-    def stop(self):
-        if not self._closing:
-            self._closing = True
-            if self._consuming:
-                self.stop_consuming()
-                self._connection.ioloop.run_forever()
-            else:
-                self._connection.ioloop.stop()
+        # Docker (and the worker supervisor) stop the workers with SIGTERM, so we drain the consumer on it.
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.on_stop_signal)
+
+        self._connection.ioloop.run_forever()
@@ -0,0 +1,141 @@
+import re
+import unicodedata
+
+
+# Quantities are normalized to these base units, so "1 kg", "1000g" and "2 x 500 g" all end up as 1000 g.
+UNIT_CONVERSIONS = {
+    "mg": (0.001, "g"),
+    "g": (1, "g"),
+    "gr": (1, "g"),
+    "kg": (1000, "g"),
+    "oz": (28.3495, "g"),
+    "lb": (453.592, "g"),
+    "ml": (1, "ml"),
+    "cl": (10, "ml"),
+    "dl": (100, "ml"),
+    "l": (1000, "ml"),
+    # Cyrillic units, common on the Eastern European products and receipts.
+    "мг": (0.001, "g"),
+    "г": (1, "g"),
+    "гр": (1, "g"),
+    "кг": (1000, "g"),
+    "мл": (1, "ml"),
+    "л": (1000, "ml"),
+}
+
+# Everything that is not a (Unicode) letter or digit. Names are multilingual, so only ASCII wouldn't do.
+NON_ALPHANUMERIC_PATTERN = re.compile(r"[\W_]+")
+# Letters that NFKD doesn't decompose to a base letter and a combining mark.
+LETTER_FOLDS = str.maketrans(
+    {"ø": "o", "ł": "l", "đ": "d", "ħ": "h", "ı": "i", "æ": "ae", "œ": "oe", "þ": "th"}
+)
+# Count of a multipack can be in front ("6 x 33 cl") or after the quantity ("2L X6"). The number must start a word,
+# so product codes like "B12 G" are not parsed as a quantity.
+QUANTITY_PATTERN = re.compile(
+    r"\b(?:(\d+)\s*x\s*)?(\d+(?:[.,]\d+)?)\s*("
+    + "|".join(UNIT_CONVERSIONS)
+    + r")(?:\s*x\s*(\d+))?\b"
+)
+MULTIPACK_TOKEN_PATTERN = re.compile(r"x\d+|\d+x")
+
+
+def normalize_text(text: str | None) -> str:
+    """
+    Case-fold the text, strip accents and replace everything that is not a letter or a digit (in any script)
+    with a single space.
+    """
+
+    if not text:
+        return ""
+
+    decomposed = unicodedata.normalize("NFKD", text)
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+
+    folded = without_accents.casefold().translate(LETTER_FOLDS)
+
+    return NON_ALPHANUMERIC_PATTERN.sub(" ", folded).strip()
+
+
+def tokenize(text: str | None) -> list[str]:
+    # We keep the order of the tokens but drop duplicates.
+    return list(dict.fromkeys(normalize_text(text).split()))
+
+
+def search_tokens(text: str | None) -> list[str]:
+    """
+    Tokenize the search text (e.g. a receipt line) without the parts that belong to the quantity
+    ("4", "x", "125g", "x6").
+    """
+
+    return [
+        token
+        for token in tokenize(text)
+        if not token.isdigit()
+        and token not in UNIT_CONVERSIONS
+        and token != "x"
+        and not MULTIPACK_TOKEN_PATTERN.fullmatch(token)
+        and not parse_quantity(token)
+    ]
+
+
+def parse_quantity(text: str | None) -> tuple[float, str] | None:
+    """
+    Parse the first quantity found in the text (e.g. "1,5L", "6 x 33 cl", "2L X6") and convert it to base unit.
+    Returns (value, unit) or None if there is no quantity in the text.
+    """
+
+    if not text:
+        return None
+
+    # Normalize the text first, but keep the decimal separators so "1,5 l" is parsed as 1.5 l.
+    normalized = unicodedata.normalize("NFKD", text).casefold().replace("×", "x")
+    match = QUANTITY_PATTERN.search(normalized)
+
+    if not match:
+        return None
+
+    count, value, unit, trailing_count = match.groups()
+    multiplier, base_unit = UNIT_CONVERSIONS[unit]
+
+    total = (
+        float(value.replace(",", "."))
+        * multiplier
+        * int(count or 1)
+        * int(trailing_count or 1)
+    )
+
+    return round(total, 3), base_unit
+
+
+def brands_text(record: dict) -> str:
+    # OpenFoodFacts has brands as a comma separated string, but other sources might only have the list of tags.
+    brands = record.get("brands")
+    if not brands and isinstance(record.get("brands_tags"), list):
+        brands = " ".join(str(tag) for tag in record["brands_tags"])
+
+    return brands if isinstance(brands, str) else ""
+
+
+def build_match_keys(record: dict) -> dict:
+    """
+    Build normalized keys used for matching receipt lines to the product.
+    They are computed once on ingest, so matching doesn't have to normalize the raw data on every query.
+    """
+
+    product_name = record.get("product_name")
+    if not isinstance(product_name, str):
+        product_name = None
+
+    quantity_text = record.get("quantity")
+    if not isinstance(quantity_text, str):
+        quantity_text = None
+
+    quantity = parse_quantity(quantity_text) or parse_quantity(product_name)
+
+    return {
+        "name": normalize_text(product_name) or None,
+        "name_tokens": tokenize(product_name),
+        "brand_tokens": tokenize(brands_text(record)),
+        "quantity_value": quantity[0] if quantity else None,
+        "quantity_unit": quantity[1] if quantity else None,
+    }
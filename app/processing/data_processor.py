@@ -2,44 +2,81 @@ import logging
 
 from datetime import datetime
 
+from bunnet import PydanticObjectId, UpdateResponse
 from pydantic import ValidationError
-from pymongo import MongoClient, UpdateOne
-from bunnet import init_bunnet
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from app import settings
+from app.bootstrap import amqp_url, init_db
 
 from app.mq import MessageConsumer
 from app.schemas import RecordsBatchForProcessing
-from app.models import Product, UploadedFile, UploadedFileStatus
+from app.models import (
+    Product,
+    UploadedFile,
+    UploadedFileStatus,
+    WorkerLoad,
+    DeadLetter,
+    ProductChange,
+)
+from app.history import (
+    BASELINE_VERSION,
+    build_baseline_checkpoint,
+    build_product_change,
+)
+from app.dead_letters import store_dead_letter
+from app.normalization import build_match_keys
+from app.worker_load import WorkerLoadReporter
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class DataProcessorException(Exception):
+    pass
 
 
 class DataProcessor:
     EXCHANGE = "company"
     CONSUME_QUEUE = "data_processing"
+    # Number of retry queues declared for the CONSUME_QUEUE in rabbitmq_definitions.json.
+    RETRIES = 4
+    HISTORY_INSERT_ATTEMPTS = 3
 
     def __init__(self):
-        user = settings.RABBITMQ_USER
-        password = settings.RABBITMQ_PASSWORD
-        host = settings.RABBITMQ_HOST
-        port = settings.RABBITMQ_PORT
-        amqp_url = f"amqp://{user}:{password}@{host}:{port}/%2F"
+        init_db([Product, UploadedFile, WorkerLoad, DeadLetter, ProductChange])
+        self.product_collection = Product.get_motor_collection()
+        self.history_collection = ProductChange.get_motor_collection()
 
+        self.load_reporter = WorkerLoadReporter("data_processor")
         self.consumer = MessageConsumer(
-            amqp_url,
+            amqp_url(),
             DataProcessor.CONSUME_QUEUE,
             DataProcessor.EXCHANGE,
             self.message_consumer,
+            on_load_report=self.load_reporter.report,
+            load_report_interval=settings.LOAD_REPORT_INTERVAL,
+            retries=DataProcessor.RETRIES,
+            on_dead_letter=self.dead_letter_consumer,
         )
 
-        client = MongoClient(settings.MONGODB_CONNECTION_URL)
-        init_bunnet(database=client["company"], document_models=[Product, UploadedFile])
-        self.product_collection = Product.get_motor_collection()
-
         self.logger = logging.getLogger("data_processor")
 
     def message_consumer(self, body, basic_deliver, properties):
         # This method is called on every message by the MessageConsumer - RabbitMQ consumer client.
-        self.process_records_and_store_them_to_database(body)
+        return self.process_records_and_store_them_to_database(body)
+
+    def dead_letter_consumer(self, body, properties, attempts, error):
+        # This method is called by the MessageConsumer for messages that failed all retries.
+        try:
+            file_id = RecordsBatchForProcessing.model_validate_json(body).file_id
+        except ValidationError:
+            file_id = None
+
+        store_dead_letter(
+            DataProcessor.CONSUME_QUEUE, file_id, body, properties, attempts, error
+        )
 
     def process_records_and_store_them_to_database(self, message_body):
         """
@@ -76,9 +113,14 @@ class DataProcessor:
             self.upsert_batch(batch_for_insert)
 
         self.update_uploaded_file_records_number_data(
-            records_batch.file_id, records_processed, records_failed
+            records_batch.file_id,
+            records_batch.split_generation,
+            records_processed,
+            records_failed,
         )
 
+        return records_processed + records_failed
+
     def prepeare_record(self, record, records_batch):
         # We need to remove the external ids if they exist and add our file_id and last_modified_at_company.
         if "id" in record:
@@ -90,6 +132,9 @@ class DataProcessor:
         record["file_id"] = records_batch.file_id
         record["last_modified_at_company"] = datetime.now()
 
+        # Precompute normalized keys for receipt matching, so it doesn't have to be done on every query.
+        record["match_keys"] = build_match_keys(record)
+
         return record
 
     def upsert_batch(self, products):
@@ -98,34 +143,183 @@ class DataProcessor:
         This gives us 10x performance improvement over multiple single item upserts using bunnet ODM.
         """
 
+        product_dicts = [product.model_dump() for product in products]
+        for product_dict in product_dicts:
+            # history_version is managed by the history, it must not come from the uploaded data.
+            product_dict.pop("history_version", None)
+
+        # History is written before the products, so if anything fails the whole batch can be retried.
+        history_versions = self.record_product_history(product_dicts)
+
         products_to_upsert = []
-        for product in products:
-            product_dict = product.model_dump()
+        for product_dict in product_dicts:
+            update = {"$set": product_dict}
+            if product_dict["code"] in history_versions:
+                # $max, so a concurrent worker that already reserved a higher version is never moved back.
+                update["$max"] = {
+                    "history_version": history_versions[product_dict["code"]]
+                }
 
             products_to_upsert.append(
-                UpdateOne(
-                    {"code": product.code},
-                    {"$set": product_dict},
-                    upsert=True,
-                )
+                UpdateOne({"code": product_dict["code"]}, update, upsert=True)
             )
 
         self.product_collection.bulk_write(products_to_upsert)
 
+    def record_product_history(self, product_dicts):
+        """
+        Store a compact diff to the product history for every product whose content was changed by this batch.
+        Returns the history versions of the changed products (by code), which are stored with the upsert.
+
+        Versions are taken optimistically from history_version of the stored products. The unique (code, version)
+        index makes sure two workers can't store the same version, the rare conflicts are resolved
+        in insert_product_history. The history is insert only.
+        """
+
+        codes = [product_dict["code"] for product_dict in product_dicts]
+        current_products = {
+            product["code"]: product
+            for product in self.product_collection.find({"code": {"$in": codes}})
+        }
+
+        # The same code can be in the batch more than once, the next one is compared with the previous one.
+        batch_products = {}
+        history_versions = {}
+
+        history_to_insert = []
+        for product_dict in product_dicts:
+            code = product_dict["code"]
+            current = batch_products.get(code) or current_products.get(code)
+            version = (current or {}).get("history_version", 0) + 1
+
+            change = build_product_change(
+                current,
+                product_dict,
+                version,
+                product_dict["file_id"],
+                product_dict["last_modified_at_company"],
+            )
+            if not change:
+                continue
+
+            # Products stored before the history was kept get their content before the change as a baseline.
+            if current and not current.get("history_version"):
+                history_to_insert.append(build_baseline_checkpoint(current))
+
+            history_to_insert.append(change)
+            history_versions[code] = version
+            batch_products[code] = {
+                **(current or {}),
+                **product_dict,
+                "history_version": version,
+            }
+
+        self.insert_product_history(history_to_insert, batch_products)
+
+        return history_versions
+
+    def build_change_with_reserved_version(self, product_dict, taken_version):
+        code = product_dict["code"]
+
+        # The version was taken by a worker that didn't store it on the product yet, so we skip past it.
+        self.product_collection.update_one(
+            {"code": code}, {"$max": {"history_version": taken_version}}
+        )
+
+        # New products are inserted with their content right away, so there is never a product without it.
+        new_product = {
+            k: v
+            for k, v in product_dict.items()
+            if k not in ("_id", "code", "history_version")
+        }
+        previous = self.product_collection.find_one_and_update(
+            {"code": code},
+            {"$inc": {"history_version": 1}, "$setOnInsert": new_product},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+
+        return build_product_change(
+            previous,
+            product_dict,
+            (previous or {}).get("history_version", 0) + 1,
+            product_dict["file_id"],
+            product_dict["last_modified_at_company"],
+        )
+
+    def insert_product_history(self, changes, batch_products):
+        """
+        Insert the history entries. If a version was already taken by another worker, we reserve a new version
+        atomically on the product ($inc of history_version) and compute the diff again against the product
+        as it was at that time (the existing entries are never overwritten).
+        """
+
+        for _ in range(DataProcessor.HISTORY_INSERT_ATTEMPTS):
+            if not changes:
+                return
+
+            try:
+                self.history_collection.insert_many(changes, ordered=False)
+                return
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                    raise
+
+                duplicates = [changes[error["index"]] for error in errors]
+
+            changes = []
+            for duplicate in duplicates:
+                # Another worker already stored the baseline, it has the same content.
+                if duplicate["version"] == BASELINE_VERSION:
+                    continue
+
+                product_dict = batch_products[duplicate["code"]]
+                change = self.build_change_with_reserved_version(
+                    product_dict, duplicate["version"]
+                )
+                if change:
+                    changes.append(change)
+
+        raise DataProcessorException(
+            f"Could not reserve history versions for products {[c['code'] for c in changes]}."
+        )
+
     def update_uploaded_file_records_number_data(
-        self, uploaded_file_id, records_processed, records_failed
+        self, uploaded_file_id, split_generation, records_processed, records_failed
     ):
+        # Files uploaded before the split generations were added don't have the field.
+        if split_generation:
+            generation_filter = {"split_generation": split_generation}
+        else:
+            generation_filter = {"split_generation": {"$in": [0, None]}}
+
         # Since there might be multiple workers updating these values we must do it this way in a single operation.
-        UploadedFile.get(uploaded_file_id).inc(
-            {
-                UploadedFile.records_processed: records_processed,
-                UploadedFile.records_failed: records_failed,
-            }
-        ).run()
+        # Batches from an older split of the file (replayed since) don't match, so they are not counted twice.
+        uploaded_file = (
+            UploadedFile.find_one(
+                {"_id": PydanticObjectId(uploaded_file_id), **generation_filter}
+            )
+            .update(
+                {
+                    "$inc": {
+                        UploadedFile.records_processed: records_processed,
+                        UploadedFile.records_failed: records_failed,
+                    }
+                },
+                response_type=UpdateResponse.NEW_DOCUMENT,
+            )
+            .run()
+        )
+
+        if not uploaded_file:
+            self.logger.warning(
+                f"File {uploaded_file_id} doesn't exist or the batch is from its older split, not counting it."
+            )
+            return
 
         # If we have processed all records from a file we will update the status of the UploadedFile record.
         # That way the status API will have up-to-date information about the uploaded file.
-        uploaded_file = UploadedFile.get(uploaded_file_id).run()
         total_processed_records = (
             uploaded_file.records_processed + uploaded_file.records_failed
         )
@@ -141,7 +335,9 @@ class DataProcessor:
         uploaded_file.save()
 
     def run(self):
+        # Returns after the consumer was drained (on SIGTERM/SIGINT).
         self.consumer.run()
+        self.load_reporter.remove()
 
 
 def main():
@@ -1,16 +1,20 @@
 import ijson
 import logging
 
+from datetime import datetime
 from pathlib import Path
-from pymongo import MongoClient
-from bunnet import init_bunnet
+from pydantic import ValidationError
 
 from app import settings
+from app.bootstrap import amqp_url, init_db
 
-from app.mq import MessageConsumer, MessagePublisher
+from app.mq import MessageConsumer, MessageInterrupted, MessagePublisher
 from app.schemas import UploadedFileMessage, RecordsBatchForProcessing
 
-from app.models import UploadedFile, UploadedFileStatus
+from app.models import UploadedFile, UploadedFileStatus, WorkerLoad, DeadLetter
+from app.dead_letters import store_dead_letter
+from app.scheduling import batch_priority
+from app.worker_load import WorkerLoadReporter
 
 
 class FileSplitterException(Exception):
@@ -22,56 +26,94 @@ class FileSplitter:
     EXCHANGE = "company"
     CONSUME_QUEUE = "file_uploaded"
     PUBLISH_QUEUE = "data_processing"
+    # Splitting is not retried automatically: a failed split might have already published some of the batches,
+    # so retrying it would process those records twice. Failed messages are dead-lettered and can be replayed.
+    RETRIES = 0
 
     def __init__(self):
-        user = settings.RABBITMQ_USER
-        password = settings.RABBITMQ_PASSWORD
-        host = settings.RABBITMQ_HOST
-        port = settings.RABBITMQ_PORT
-        amqp_url = f"amqp://{user}:{password}@{host}:{port}/%2F"
+        init_db([UploadedFile, WorkerLoad, DeadLetter])
 
+        self.load_reporter = WorkerLoadReporter("file_splitter")
         self.consumer = MessageConsumer(
-            amqp_url,
+            amqp_url(),
             FileSplitter.CONSUME_QUEUE,
             FileSplitter.EXCHANGE,
             self.message_consumer,
+            on_load_report=self.load_reporter.report,
+            load_report_interval=settings.LOAD_REPORT_INTERVAL,
+            retries=FileSplitter.RETRIES,
+            on_dead_letter=self.dead_letter_consumer,
         )
 
-        self.publisher = MessagePublisher(amqp_url, "file_splitter")
+        self.publisher = MessagePublisher(amqp_url(), "file_splitter")
         self.publisher.connect()
 
-        client = MongoClient(settings.MONGODB_CONNECTION_URL)
-        init_bunnet(database=client["company"], document_models=[UploadedFile])
-
         self.logger = logging.getLogger("file_splitter")
 
     def message_consumer(self, body, basic_deliver, properties):
         # This method is called on every message by the MessageConsumer - RabbitMQ consumer client.
-        self.split_uploaded_files_and_send_records_to_processing(body)
+        return self.split_uploaded_files_and_send_records_to_processing(body)
+
+    def dead_letter_consumer(self, body, properties, attempts, error):
+        # This method is called by the MessageConsumer for messages that failed all retries.
+        try:
+            file_id = UploadedFileMessage.model_validate_json(body).id
+        except ValidationError:
+            file_id = None
+
+        store_dead_letter(
+            FileSplitter.CONSUME_QUEUE, file_id, body, properties, attempts, error
+        )
 
     def split_uploaded_files_and_send_records_to_processing(self, message_body):
         """
         This is the core method of the FileSplitter. It gets the uploaded file from storage and reads it, in chunks.
-        It then extracts records from the file and sends them in batches
+        First it pre-scans the whole file, so we know that it is valid and how many records it contains before any
+        batch is published. It then extracts records from the file and sends them in batches
         to data processor service, so they can be processed and saved to the database.
         If everything went well it deletes the uploaded file.
 
+        If the worker is stopped in the middle of the file, the rest of the file is put back to the queue
+        (see MessageInterrupted) and the next FileSplitter continues where this one stopped.
+
         """
         uploaded_file_message = UploadedFileMessage.model_validate_json(message_body)
 
+        total_records = 0
         file_should_be_deleted = True
         try:
-            self.update_file_status(
-                uploaded_file_message.id, UploadedFileStatus.processing
-            )
-
-            total_records = self.extract_records_and_send_them_to_processing(
-                uploaded_file_message
-            )
-
-            self.update_number_of_records(uploaded_file_message.id, total_records)
-
-        except ijson.common.IncompleteJSONError as e:
+            if uploaded_file_message.resume_from:
+                # The file was already pre-scanned by the FileSplitter that started splitting it.
+                total_records = self.get_number_of_records(uploaded_file_message.id)
+            else:
+                self.update_file_status(
+                    uploaded_file_message.id, UploadedFileStatus.processing
+                )
+
+                # Total records are set before publishing, so the progress can be tracked from the start and
+                # DataProcessor can't mark the file as processed before all of its batches were sent.
+                total_records = self.prescan_file(uploaded_file_message)
+                self.update_number_of_records(uploaded_file_message.id, total_records)
+
+            if total_records == 0:
+                self.update_file_status(
+                    uploaded_file_message.id, UploadedFileStatus.processed
+                )
+            else:
+                records_sent = self.extract_records_and_send_them_to_processing(
+                    uploaded_file_message
+                )
+
+                if records_sent != total_records:
+                    raise FileSplitterException(
+                        f"Pre-scan found {total_records} records but {records_sent} were sent "
+                        f"for file {uploaded_file_message.id}."
+                    )
+
+        except MessageInterrupted:
+            raise
+
+        except ijson.common.JSONError as e:
             self.update_file_status(
                 uploaded_file_message.id, UploadedFileStatus.failed, raise_exc=False
             )
@@ -95,6 +137,8 @@ class FileSplitter:
         if file_should_be_deleted:
             self.delete_file(uploaded_file_message.location)
 
+        return total_records - uploaded_file_message.resume_from
+
     def update_file_status(self, uploaded_file_id, status, raise_exc=True):
         uploaded_file = UploadedFile.get(uploaded_file_id).run()
 
@@ -108,40 +152,120 @@ class FileSplitter:
             return
 
         uploaded_file.status = status
+        if status == UploadedFileStatus.processing:
+            uploaded_file.processing_started_at = datetime.now()
+
         uploaded_file.save()
 
+    def prescan_file(self, uploaded_file_message):
+        """
+        Validate the structure of the whole file and count the records in it before anything is published.
+        Records are parsed by the C-accelerated ijson backend (yajl2_c, if available) and dropped right away,
+        which is faster than going through the individual parser events in Python.
+        Raises ijson JSONError if the file is not a valid json array of objects.
+        If the worker is draining, the pre-scan stops and the file is put back to the queue as it was.
+        """
+        with open(uploaded_file_message.location, "rb") as file:
+            first_event = next(ijson.parse(file), None)
+            if not first_event or first_event[1] != "start_array":
+                raise ijson.common.JSONError("Uploaded file must contain a json array.")
+
+            file.seek(0)
+            total_records = 0
+            for record in ijson.items(file, "item"):
+                if (
+                    total_records % FileSplitter.BATCH_SIZE == 0
+                    and self.consumer.drain_requested
+                ):
+                    self.interrupt_splitting(uploaded_file_message, 0)
+
+                # Records that are not objects would fail the batch validation after earlier batches were published.
+                if not isinstance(record, dict):
+                    raise ijson.common.JSONError(
+                        f"Record {total_records} of the uploaded file is not a json object."
+                    )
+                total_records += 1
+
+            return total_records
+
     def extract_records_and_send_them_to_processing(self, uploaded_file_message):
+        resume_from = uploaded_file_message.resume_from
         total_records = 0
         batch = []
 
         with open(uploaded_file_message.location, "rb") as file:
             for record in ijson.items(file, "item"):
-                batch.append(record)
                 total_records += 1
+                if total_records <= resume_from:
+                    continue
+
+                # Stop between batches when the worker is draining, so it doesn't block the shutdown
+                # and the batches that were already sent are not sent again.
+                if not batch and self.consumer.drain_requested:
+                    self.interrupt_splitting(uploaded_file_message, total_records - 1)
+
+                batch.append(record)
 
                 if len(batch) == FileSplitter.BATCH_SIZE:
-                    self.publish_batch_for_processing(batch, uploaded_file_message.id)
+                    self.publish_batch_for_processing(
+                        batch,
+                        uploaded_file_message,
+                        batch_priority(
+                            uploaded_file_message.priority, total_records - len(batch)
+                        ),
+                    )
 
                     batch = []
 
         # Publish leftover records.
-        self.publish_batch_for_processing(batch, uploaded_file_message.id)
+        self.publish_batch_for_processing(
+            batch,
+            uploaded_file_message,
+            batch_priority(uploaded_file_message.priority, total_records - len(batch)),
+        )
 
         return total_records
 
-    def publish_batch_for_processing(self, batch, file_id):
+    def interrupt_splitting(self, uploaded_file_message, records_sent):
+        self.logger.warning(
+            f"Stopped splitting file {uploaded_file_message.id} after {records_sent} sent records, "
+            f"the rest is put back to the queue."
+        )
+
+        resumed_message = uploaded_file_message.model_copy(
+            update={"resume_from": records_sent}
+        )
+        raise MessageInterrupted(
+            resumed_message.model_dump_json(),
+            records=records_sent - uploaded_file_message.resume_from,
+        )
+
+    def publish_batch_for_processing(self, batch, uploaded_file_message, priority):
         if not batch:
             return
 
         records_for_processing = RecordsBatchForProcessing(
-            file_id=file_id, records=batch
+            file_id=uploaded_file_message.id,
+            records=batch,
+            split_generation=uploaded_file_message.split_generation,
         )
         self.publisher.publish_message(
             records_for_processing.model_dump_json(),
             FileSplitter.EXCHANGE,
             FileSplitter.PUBLISH_QUEUE,
+            priority=priority,
         )
 
+    def get_number_of_records(self, uploaded_file_id):
+        uploaded_file = UploadedFile.get(uploaded_file_id).run()
+
+        if not uploaded_file:
+            raise FileSplitterException(
+                f"UploadedFile record with id {uploaded_file_id} not found."
+            )
+
+        return uploaded_file.total_records
+
     def update_number_of_records(self, uploaded_file_id, number_of_records):
         uploaded_file = UploadedFile.get(uploaded_file_id).run()
 
@@ -161,8 +285,13 @@ class FileSplitter:
             self.logger.warning(f"File {file_location} already deleted.")
 
     def run(self):
+        # Returns after the consumer was drained (on SIGTERM/SIGINT).
         self.consumer.run()
 
+        # Make sure all batches of the last file are flushed to RabbitMQ before the process exits.
+        self.publisher.drain()
+        self.load_reporter.remove()
+
 
 def main():
     file_splitter = FileSplitter()
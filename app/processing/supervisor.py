@@ -0,0 +1,205 @@
+import importlib
+import logging
+import math
+import multiprocessing
+import signal
+import sys
+import time
+
+import pika
+
+from app import settings
+from app.bootstrap import amqp_url
+from app.mq import MessageConsumer
+
+
+logger = logging.getLogger("supervisor")
+
+# Service name -> (module that runs the worker, queue it consumes).
+SERVICES = {
+    "data_processor": ("app.processing.data_processor", "data_processing"),
+    "file_splitter": ("app.processing.file_splitter", "file_uploaded"),
+}
+
+# Splitting a file can take minutes, so these services get a new worker for every waiting message instead of one
+# per BACKLOG_PER_WORKER messages. Otherwise a small urgent file would wait until a big one is split.
+SCALE_PER_WAITING_MESSAGE = {"file_splitter"}
+
+
+class SupervisorException(Exception):
+    pass
+
+
+class Supervisor:
+    """
+    Runs between WORKERS_MIN and WORKERS_MAX worker processes of a service and scales their number
+    according to the backlog in the queue the service consumes. Every worker has a shared memory flag that
+    tells if it's processing a message, so idle workers are stopped first.
+
+    Workers are scaled down with SIGTERM, so they drain gracefully: DataProcessor finishes and acknowledges
+    the in-flight batch, FileSplitter stops after the current batch of records and puts the rest of the file
+    back to the queue, so even a worker in the middle of a big file stops right away.
+
+    The worker module is imported once here and workers are forked from the supervisor, so a new worker doesn't have
+    to import everything again and is ready to consume right away.
+    """
+
+    # How long we wait for the workers to drain before killing them. Draining takes at most one batch,
+    # a worker killed after the timeout would have its message redelivered and processed again.
+    STOP_TIMEOUT = 60
+
+    def __init__(self, service):
+        if service not in SERVICES:
+            raise SupervisorException(
+                f"Unknown service {service}, choose one of: {', '.join(SERVICES)}."
+            )
+
+        self.service = service
+        self.module, self.queue = SERVICES[service]
+
+        self.min_workers = max(settings.WORKERS_MIN, 1)
+        self.max_workers = max(settings.WORKERS_MAX, self.min_workers)
+
+        self.amqp_url = amqp_url()
+
+        # Only import the module here, its main creates the connections and must run in the worker process.
+        self.worker_main = importlib.import_module(self.module).main
+        self.multiprocessing = multiprocessing.get_context("fork")
+
+        self.workers: list[multiprocessing.Process] = []
+        self.busy_flags = {}
+        # Stopped workers that are still draining -> time by which they must exit.
+        self.draining: dict[multiprocessing.Process, float] = {}
+        self._stopping = False
+
+    def queue_depth(self):
+        connection = pika.BlockingConnection(pika.URLParameters(self.amqp_url))
+        try:
+            channel = connection.channel()
+            result = channel.queue_declare(self.queue, passive=True)
+            return result.method.message_count
+        finally:
+            connection.close()
+
+    def is_busy(self, worker):
+        return bool(self.busy_flags[worker].value)
+
+    def desired_number_of_workers(self, queue_depth):
+        if self.service in SCALE_PER_WAITING_MESSAGE:
+            # Waiting messages mean the busy workers can't take them, so each one needs another worker.
+            desired = sum(self.is_busy(w) for w in self.workers) + queue_depth
+        else:
+            desired = math.ceil(queue_depth / settings.BACKLOG_PER_WORKER)
+
+        return min(max(desired, self.min_workers), self.max_workers)
+
+    def run_worker(self, busy_flag):
+        # Forked worker inherits the signal handlers of the supervisor, the worker sets its own once it's running.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        MessageConsumer.busy_flag = busy_flag
+        self.worker_main()
+
+    def start_worker(self):
+        busy_flag = self.multiprocessing.Value("b", False, lock=False)
+        worker = self.multiprocessing.Process(target=self.run_worker, args=(busy_flag,))
+        worker.start()
+        self.workers.append(worker)
+        self.busy_flags[worker] = busy_flag
+        logger.warning(f"Started {self.service} worker {worker.pid}.")
+
+    def worker_to_stop(self):
+        # We stop the newest idle worker (the newest one if all are busy), the oldest ones have warmed up
+        # connections and caches.
+        for worker in reversed(self.workers):
+            if not self.is_busy(worker):
+                return worker
+
+        return self.workers[-1]
+
+    def stop_worker(self, worker):
+        self.workers.remove(worker)
+        del self.busy_flags[worker]
+        worker.terminate()
+        self.draining[worker] = time.monotonic() + Supervisor.STOP_TIMEOUT
+        logger.warning(f"Draining {self.service} worker {worker.pid}.")
+
+    def remove_drained_workers(self):
+        # Joining reaps the exited workers, the ones that didn't drain in time are killed.
+        for worker, deadline in list(self.draining.items()):
+            if worker.is_alive() and time.monotonic() < deadline:
+                continue
+
+            if worker.is_alive():
+                logger.error(
+                    f"{self.service} worker {worker.pid} did not drain in time."
+                )
+                worker.kill()
+
+            worker.join()
+            del self.draining[worker]
+
+    def remove_exited_workers(self):
+        for worker in list(self.workers):
+            if not worker.is_alive():
+                logger.error(
+                    f"{self.service} worker {worker.pid} exited with code {worker.exitcode}."
+                )
+                self.workers.remove(worker)
+                del self.busy_flags[worker]
+
+    def scale(self):
+        self.remove_exited_workers()
+        self.remove_drained_workers()
+
+        try:
+            desired = self.desired_number_of_workers(self.queue_depth())
+        except pika.exceptions.AMQPError as e:
+            logger.warning(f"Could not check the queue depth: {e}")
+            desired = max(len(self.workers), self.min_workers)
+
+        while len(self.workers) < desired:
+            self.start_worker()
+
+        # Scale up fast, but scale down one worker at a time, so short dips in the backlog don't cause churn.
+        if len(self.workers) > desired:
+            self.stop_worker(self.worker_to_stop())
+
+    def stop(self, *_args):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self._stopping:
+            self.scale()
+
+            # Sleep in short steps so we react to the stop signal quickly.
+            deadline = time.monotonic() + settings.SUPERVISOR_INTERVAL
+            while not self._stopping and time.monotonic() < deadline:
+                time.sleep(0.5)
+
+        self.stop_all_workers()
+
+    def stop_all_workers(self):
+        for worker in list(self.workers):
+            self.stop_worker(worker)
+
+        while self.draining:
+            self.remove_drained_workers()
+            time.sleep(0.1)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: python -m app.processing.supervisor [{'|'.join(SERVICES)}]")
+        sys.exit(1)
+
+    supervisor = Supervisor(sys.argv[1])
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
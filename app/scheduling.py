@@ -0,0 +1,66 @@
+from datetime import datetime
+
+
+# RabbitMQ recommends using at most 10 priority levels. Queues are declared with x-max-priority = MAX_PRIORITY.
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 5
+
+# After every FAIR_SHARE_STEP-fold increase of the records sent from a single file, its batches are demoted by one
+# priority level: the first 10k records keep the file priority, records up to 100k get priority - 1, etc.
+# That way a large file can't starve the small files with the same priority that were uploaded after it.
+FAIR_SHARE_RECORDS = 10_000
+FAIR_SHARE_STEP = 10
+MAX_FAIR_SHARE_DEMOTION = 3
+
+
+def batch_priority(file_priority: int, records_sent: int) -> int:
+    """
+    Priority of the next batch of a file, given the number of records that were already sent from that file.
+    """
+
+    demotion = 0
+    threshold = FAIR_SHARE_RECORDS
+    while records_sent >= threshold and demotion < MAX_FAIR_SHARE_DEMOTION:
+        demotion += 1
+        threshold *= FAIR_SHARE_STEP
+
+    return max(file_priority - demotion, 0)
+
+
+def estimate_seconds_left(
+    total_records: int,
+    records_done: int,
+    processing_started_at: datetime | None,
+    now: datetime,
+) -> float | None:
+    """
+    Estimate how long the processing of the file will take based on its throughput so far.
+    Returns None if there isn't enough data for the estimate yet.
+    """
+
+    if not processing_started_at or not total_records or not records_done:
+        return None
+
+    elapsed = (now - processing_started_at).total_seconds()
+    if elapsed <= 0:
+        return None
+
+    records_per_second = records_done / elapsed
+    remaining = max(total_records - records_done, 0)
+
+    return round(remaining / records_per_second, 1)
+
+
+def estimate_seconds_in_queue(
+    records_ahead: int, records_left: int, records_per_second: float
+) -> float | None:
+    """
+    Estimate how long it will take until a file that is still waiting is processed: the records of the files
+    ahead of it and its own records at the recent throughput of all workers.
+    Returns None if there is no recent throughput to base the estimate on.
+    """
+
+    if records_per_second <= 0:
+        return None
+
+    return round((records_ahead + records_left) / records_per_second, 1)
@@ -2,6 +2,7 @@ from pydantic import BaseModel
 from datetime import datetime
 
 from .models import Product
+from .scheduling import DEFAULT_PRIORITY
 
 
 class UploadedFileResponse(BaseModel):
@@ -24,9 +25,19 @@ class UploadedFileStatus(BaseModel):
     status: str
     uploaded_at: datetime
 
+    priority: int
+
     total_records: int
     records_processed: int
     records_failed: int
+    # Number of batches that failed all retries, see /upload/{file_id}/dead-letters.
+    dead_letters: int = 0
+
+    # Number of unfinished files that will be processed before this one, None if the file is already processed.
+    queue_position: int | None = None
+    # Estimated seconds until the file is processed. While the file is waiting it is based on the records of the files
+    # ahead of it and the recent throughput of the workers, None if there is no data for the estimate.
+    eta_seconds: float | None = None
 
 
 class UploadedFileMessage(BaseModel):
@@ -37,6 +48,12 @@ class UploadedFileMessage(BaseModel):
     id: str
     location: str
     uploaded_at: datetime
+    priority: int = DEFAULT_PRIORITY
+    # Number of records that were already sent to processing by a FileSplitter that was stopped in the middle
+    # of the file. Splitting continues after them.
+    resume_from: int = 0
+    # Increased every time the file is split again (see UploadedFile.split_generation).
+    split_generation: int = 0
 
 
 class RecordsBatchForProcessing(BaseModel):
@@ -46,11 +63,93 @@ class RecordsBatchForProcessing(BaseModel):
 
     file_id: str
     records: list[dict]
+    # Batches from an older split of the file are stored, but not counted to its progress.
+    split_generation: int = 0
 
 
 class MultipleProducts(BaseModel):
     """
     Response containing multiple products.
+    If there are more products to fetch, next_cursor is the token for the next page.
     """
 
+    search_term: str | None = None
     products: list[Product]
+    next_cursor: str | None = None
+
+
+class WorkerLoadStatus(BaseModel):
+    """
+    Load of a single worker.
+    """
+
+    worker_id: str
+    queue_depth: int
+    utilization: float
+    records_per_second: float
+    updated_at: datetime
+
+
+class ServiceLoad(BaseModel):
+    """
+    Load of all running workers of a service.
+    """
+
+    service: str
+    queue: str
+    queue_depth: int
+    workers: int
+    utilization: float
+    records_per_second: float
+    worker_load: list[WorkerLoadStatus]
+
+
+class WorkersLoadResponse(BaseModel):
+    """
+    Response of the workers load API.
+    """
+
+    services: list[ServiceLoad]
+
+
+class DeadLetterInfo(BaseModel):
+    """
+    Message that failed processing after all retries.
+    """
+
+    id: str
+    queue: str
+    file_id: str | None
+    attempts: int
+    error: str
+    dead_lettered_at: datetime
+    replayed_at: datetime | None
+
+
+class DeadLettersResponse(BaseModel):
+    """
+    Response containing dead-lettered messages of an uploaded file.
+    """
+
+    file_id: str
+    dead_letters: list[DeadLetterInfo]
+
+
+class ReplayedDeadLettersResponse(BaseModel):
+    """
+    Response of the dead letters replay API.
+    """
+
+    replayed: int
+
+
+class ProductSnapshot(BaseModel):
+    """
+    Product content reconstructed from the product history as of some time or file.
+    """
+
+    code: str
+    version: int
+    file_id: str
+    changed_at: datetime
+    product: dict
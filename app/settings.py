@@ -18,3 +18,13 @@ FILES_DIRECTORY = os.getenv(
     "FILES_DIRECTORY",
     "/data/uploaded_files",
 )
+
+# Worker load reporting and autoscaling (see app/processing/supervisor.py).
+LOAD_REPORT_INTERVAL = int(os.getenv("LOAD_REPORT_INTERVAL", 10))
+
+WORKERS_MIN = int(os.getenv("WORKERS_MIN", 1))
+WORKERS_MAX = int(os.getenv("WORKERS_MAX", os.cpu_count() or 1))
+# Number of messages waiting in the queue per one worker process. FileSplitter ignores it and gets a new worker
+# for every waiting file (see SCALE_PER_WAITING_MESSAGE in the supervisor).
+BACKLOG_PER_WORKER = int(os.getenv("BACKLOG_PER_WORKER", 50))
+SUPERVISOR_INTERVAL = int(os.getenv("SUPERVISOR_INTERVAL", 15))
@@ -0,0 +1,34 @@
+import os
+import socket
+
+from datetime import datetime
+
+from app.models import WorkerLoad
+
+
+class WorkerLoadReporter:
+    """
+    Stores the load reported by the MessageConsumer of a worker, so it can be seen through the API.
+    """
+
+    def __init__(self, service: str):
+        self.service = service
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.collection = WorkerLoad.get_motor_collection()
+
+    def report(self, load: dict):
+        self.collection.update_one(
+            {"worker_id": self.worker_id},
+            {
+                "$set": {
+                    **load,
+                    "service": self.service,
+                    "updated_at": datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+
+    def remove(self):
+        # Called when the worker is stopped, so it isn't shown as a running worker anymore.
+        self.collection.delete_one({"worker_id": self.worker_id})
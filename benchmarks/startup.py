@@ -0,0 +1,117 @@
+"""
+Benchmark of the import time and startup (readiness) time of the services.
+
+Import time is measured in a fresh interpreter for every run:
+    python -m benchmarks.startup
+
+Readiness is the time from starting a worker until its consumer is registered on the queue. It needs running MongoDB
+and RabbitMQ (configured the same way as the services) and measures both a worker started as a new process and
+a worker forked from the supervisor (which has the worker module already imported):
+    python -m benchmarks.startup --readiness
+"""
+
+import multiprocessing
+import statistics
+import subprocess
+import sys
+import time
+
+from importlib import import_module
+
+
+MODULES = [
+    "app.api.main",
+    "app.processing.data_processor",
+    "app.processing.file_splitter",
+    "app.processing.supervisor",
+]
+
+WORKERS = {
+    "data_processor": ("app.processing.data_processor", "data_processing"),
+    "file_splitter": ("app.processing.file_splitter", "file_uploaded"),
+}
+
+RUNS = 5
+READINESS_TARGET_SECONDS = 1.0
+READINESS_TIMEOUT_SECONDS = 30
+
+
+def import_time(module):
+    code = (
+        "import time; started_at = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - started_at)"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+
+    return float(output.strip().splitlines()[-1])
+
+
+def consumer_count(queue):
+    import pika
+
+    from app.bootstrap import amqp_url
+
+    connection = pika.BlockingConnection(pika.URLParameters(amqp_url()))
+    try:
+        result = connection.channel().queue_declare(queue, passive=True)
+        return result.method.consumer_count
+    finally:
+        connection.close()
+
+
+def wait_until_ready(queue, consumers_before, started_at):
+    while time.perf_counter() - started_at < READINESS_TIMEOUT_SECONDS:
+        if consumer_count(queue) > consumers_before:
+            return time.perf_counter() - started_at
+        time.sleep(0.02)
+
+    raise TimeoutError(f"Worker consuming {queue} did not become ready.")
+
+
+def readiness_time(module, queue, fork):
+    consumers_before = consumer_count(queue)
+
+    started_at = time.perf_counter()
+    if fork:
+        worker = multiprocessing.get_context("fork").Process(
+            target=import_module(module).main
+        )
+        worker.start()
+    else:
+        worker = subprocess.Popen([sys.executable, "-m", module])
+
+    try:
+        return wait_until_ready(queue, consumers_before, started_at)
+    finally:
+        worker.terminate()
+        if fork:
+            worker.join()
+        else:
+            worker.wait()
+
+
+def report(name, times, target=None):
+    result = f"{name:<45} median {statistics.median(times):.3f}s  min {min(times):.3f}s"
+    if target is not None:
+        result += "  OK" if statistics.median(times) < target else "  SLOW"
+    print(result)
+
+
+def main():
+    print("Import time")
+    for module in MODULES:
+        report(module, [import_time(module) for _ in range(RUNS)])
+
+    if "--readiness" not in sys.argv:
+        return
+
+    print(f"\nReadiness (target {READINESS_TARGET_SECONDS}s)")
+    for worker, (module, queue) in WORKERS.items():
+        for fork in (False, True):
+            name = f"{worker} ({'forked by supervisor' if fork else 'new process'})"
+            times = [readiness_time(module, queue, fork) for _ in range(RUNS)]
+            report(name, times, READINESS_TARGET_SECONDS)
+
+
+if __name__ == "__main__":
+    main()